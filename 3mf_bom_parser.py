@@ -1,20 +1,45 @@
 #!/usr/bin/env python3
 import zipfile
-import xml.etree.ElementTree as ET
+import io
 from collections import Counter
 import sys
 import os
 import urllib.request
 import urllib.parse
 import json
+import hashlib
 import time
 import re
 import argparse
+import functools
 
+# Use lxml when it is installed; fall back to the standard library.
+# Both provide the ElementTree API used below.
+try:
+    import lxml.etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+# Queries matching this are stacking tiles (likely utility parts) and get no search URL
+TILE_STACK_RE = re.compile(r"Tile.* Stack")
+
+# Parsed BOMs are cached here, keyed by the 3MF file's path, mtime and size.
+# Bump BOM_CACHE_VERSION whenever the parsing logic changes the resulting BOM.
+BOM_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), '3mf-tools', 'bom')
+BOM_CACHE_VERSION = 1
+
+# Read buffer sizes used for the archive file and when streaming XML members out of it
+ARCHIVE_READ_BUFFER_SIZE = 1024 * 1024
+MODEL_READ_BUFFER_SIZE = 128 * 1024
+CONFIG_READ_BUFFER_SIZE = 64 * 1024
+
+@functools.lru_cache(maxsize=1024)
 def local_name(tag):
     """
     Returns the local name of an XML tag, stripping the namespace.
     Example: '{http://schemas.microsoft.com/3mf/2013/3/3mf}model' -> 'model'
+    Results are cached, since a document only uses a handful of distinct tags
+    but this is called for every element.
     """
     if '}' in tag:
         return tag.split('}', 1)[1]
@@ -24,106 +49,164 @@ def clean_part_name(name):
     """
     Removes .stl extension from the name if present (case-insensitive).
     """
-    if name and name.lower().endswith('.stl'):
+    # Only lowercase the 4-character tail, not the whole name
+    if name and name[-4:].lower() == '.stl':
         return name[:-4]
     return name
 
-def find_child_by_name(element, name):
-    """Finds the first direct child with a specific local name (ignoring namespace)."""
-    for child in element:
-        if local_name(child.tag) == name:
-            return child
-    return None
-
 def find_all_children_by_name(element, name):
     """Finds all direct children with a specific local name (ignoring namespace)."""
-    found = []
-    for child in element:
-        if local_name(child.tag) == name:
-            found.append(child)
+    return element.findall('{*}' + name)
+
+def metadata_dict(element):
+    """
+    Builds a {key: value} map from the direct <metadata> children of an element,
+    handling both <metadata key="...">value</metadata>
+    and <metadata key="..." value="..."/>. The first non-empty value for a key wins.
+    """
+    found = {}
+    for meta in find_all_children_by_name(element, 'metadata'):
+        key = meta.get('key')
+        if not key or key in found:
+            continue
+        # Check 'value' attribute first (common in model_settings.config), then text content
+        val = meta.get('value') or (meta.text.strip() if meta.text else None)
+        if val:
+            found[key] = val
     return found
 
-def get_metadata_value(element, key_name):
+def find_member(zf, candidates):
     """
-    Helper to find <metadata key="...">value</metadata>
-    or <metadata key="..." value="..."/>
+    Returns the ZipInfo of the first candidate path present in the archive, or None.
+    Looks names up in the archive's index instead of scanning zf.namelist().
     """
-    for meta in element.iter():
-        if local_name(meta.tag) == 'metadata':
-            if meta.get('key') == key_name:
-                # Check 'value' attribute first (common in model_settings.config)
-                val = meta.get('value')
-                if val:
-                    return val
-                # Fallback to text content
-                if meta.text:
-                    return meta.text.strip()
+    for name in candidates:
+        info = zf.NameToInfo.get(name)
+        if info is not None:
+            return info
     return None
 
+def open_member(zf, member, buffer_size):
+    """
+    Opens a file (name or ZipInfo) inside the archive wrapped in a BufferedReader, so the
+    XML parser pulls large chunks through the decompressor instead of many small reads.
+    """
+    return io.BufferedReader(zf.open(member), buffer_size=buffer_size)
+
 def extract_names_from_config(zf):
     """
     Parses Metadata/model_settings.config (or .xml) to create a map of Object ID -> List of Part Names.
     """
-    possible_paths = ['Metadata/model_settings.config', 'Metadata/model_settings.xml']
-    config_path = None
-    for p in possible_paths:
-        if p in zf.namelist():
-            config_path = p
-            break
-
-    if not config_path:
+    config_info = find_member(zf, ('Metadata/model_settings.config', 'Metadata/model_settings.xml'))
+    if config_info is None:
         return {}
+    config_path = config_info.filename
 
     id_to_names = {} # Maps object_id (str) -> list of names [str]
 
+    # Bound to locals for the per-element loop below
+    _local_name = local_name
+    _metadata_dict = metadata_dict
+    _clean_part_name = clean_part_name
+
     try:
-        with zf.open(config_path) as f:
-            tree = ET.parse(f)
-            root = tree.getroot()
-            config = find_child_by_name(root, 'config')
-
-            # If config element isn't found (e.g. root IS config), fallback to root
-            search_root = config if config is not None else root
-
-            # Find all 'object' elements anywhere in the tree
-            for obj in search_root.iter():
-                if local_name(obj.tag) == 'object':
-                    obj_id = obj.get('id')
-                    if not obj_id:
-                        continue
-
-                    # Find all 'part' children of this object
-                    parts = []
-                    for child in obj:
-                        if local_name(child.tag) == 'part':
-                            parts.append(child)
-
-                    names_for_this_object = []
-
-                    # Logic: If 1 or 0 parts, use Object Metadata. If >1 parts, use Part Metadata.
-                    if len(parts) <= 1:
-                        # Use the Object's metadata name
-                        name = get_metadata_value(obj, 'name')
-                        if name:
-                            names_for_this_object.append(clean_part_name(name))
-                    else:
-                        # Use each Part's metadata name
-                        for part in parts:
-                            p_name = get_metadata_value(part, 'name')
-                            if p_name:
-                                names_for_this_object.append(clean_part_name(p_name))
-                            else:
-                                names_for_this_object.append(f"Unnamed Component of Object {obj_id}")
-
-                    # Only add to map if we found names
-                    if names_for_this_object:
-                        id_to_names[str(obj_id)] = names_for_this_object
+        with open_member(zf, config_info, CONFIG_READ_BUFFER_SIZE) as f:
+            # Stream the config, handling each 'object' element (anywhere in the
+            # tree) as soon as it is complete, then clearing it to bound memory.
+            for event, obj in ET.iterparse(f, events=('end',)):
+                if _local_name(obj.tag) != 'object':
+                    continue
+
+                obj_id = obj.get('id')
+                if not obj_id:
+                    obj.clear()
+                    continue
+
+                # Find all 'part' children of this object
+                parts = find_all_children_by_name(obj, 'part')
+
+                names_for_this_object = []
+
+                # Logic: If 1 or 0 parts, use Object Metadata. If >1 parts, use Part Metadata.
+                if len(parts) <= 1:
+                    # Use the Object's metadata name, else the single Part's name
+                    name = _metadata_dict(obj).get('name')
+                    if not name and parts:
+                        name = _metadata_dict(parts[0]).get('name')
+                    if name:
+                        names_for_this_object.append(_clean_part_name(name))
+                else:
+                    # Use each Part's metadata name
+                    for part in parts:
+                        p_name = _metadata_dict(part).get('name')
+                        if p_name:
+                            names_for_this_object.append(_clean_part_name(p_name))
+                        else:
+                            names_for_this_object.append(f"Unnamed Component of Object {obj_id}")
+
+                # Only add to map if we found names
+                if names_for_this_object:
+                    id_to_names[str(obj_id)] = names_for_this_object
+
+                obj.clear()
 
     except Exception as e:
         print(f"Warning: Found {config_path} but failed to parse it: {e}")
 
     return id_to_names
 
+def scan_model_xml(f):
+    """
+    Stream-parses a 3dmodel.model file object in a single pass.
+    Returns (resource_names, build_object_ids):
+      resource_names   - Dict[object ID -> name] from <resources>/<object>
+      build_object_ids - List of object IDs referenced by <build>/<item>, in order
+    Either value is None if its section is missing. Elements are cleared as soon
+    as they are processed so large meshes are never held in memory as a tree.
+    """
+    resource_names = None
+    build_object_ids = None
+    path = [] # Local names of the currently open elements, root first
+
+    # This loop runs for the start and end of every element (every vertex and
+    # triangle), so bind the functions it calls to locals
+    _local_name = local_name
+    _clean_part_name = clean_part_name
+    push = path.append
+    pop = path.pop
+
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            push(_local_name(elem.tag))
+            if len(path) == 2:
+                if path[1] == 'resources' and resource_names is None:
+                    resource_names = {}
+                elif path[1] == 'build' and build_object_ids is None:
+                    build_object_ids = []
+            continue
+
+        name = pop()
+        depth = len(path)
+
+        if depth == 2:
+            parent = path[1]
+            if name == 'object' and parent == 'resources':
+                object_id = elem.get('id')
+                if object_id:
+                    resource_names[object_id] = _clean_part_name(elem.get('name'))
+            elif name == 'item' and parent == 'build':
+                object_id = elem.get('objectid')
+                if object_id:
+                    build_object_ids.append(object_id)
+
+        # Clear every element (except the root) as soon as it ends. Besides freeing
+        # memory, this keeps lxml fast: clearing an <object> that still holds its
+        # whole mesh is far slower than clearing each vertex/triangle as it goes.
+        if depth:
+            elem.clear()
+
+    return resource_names, build_object_ids
+
 def search_thangs(query):
     """
     Generates a direct search link for Thangs.com using the frontend URL format.
@@ -134,7 +217,7 @@ def search_thangs(query):
         return []
 
     # Skip URL generation for stacking tiles (likely utility parts)
-    if re.search(r"Tile.* Stack", query):
+    if TILE_STACK_RE.search(query):
         return []
 
     # 1. Enclose the query in double quotes as requested
@@ -142,7 +225,8 @@ def search_thangs(query):
 
     # 2. URL Encode the query (spaces -> %20, quotes -> %22)
     # quote() uses %20 for spaces, which matches the user's requirement better than quote_plus()
-    encoded_query = urllib.parse.quote(quoted_query)
+    # safe='' also encodes '/', since the query is a single path segment
+    encoded_query = urllib.parse.quote(quoted_query, safe='')
 
     # 3. Construct the URL
     url = f"https://thangs.com/search/{encoded_query}?searchScope=thangs&view=list"
@@ -150,82 +234,120 @@ def search_thangs(query):
     # Return as a list to maintain compatibility with the BOM printing loop
     return [url]
 
-def parse_3mf_for_bom(filepath: str, show_urls: bool = False):
+def bom_cache_key(filepath):
     """
-    Reads a 3MF file, parses the internal 3D model XML, and prints a Bill of Materials (BOM).
+    Returns the key identifying the current contents of a 3MF file for the BOM cache.
     """
-    if not os.path.exists(filepath):
-        print(f"Error: File not found at '{filepath}'")
-        return
+    return f"{BOM_CACHE_VERSION}-{os.path.getmtime(filepath)}-{os.path.getsize(filepath)}"
 
-    print(f"--- Analyzing 3MF File: {os.path.basename(filepath)} ---")
+def bom_cache_path(filepath):
+    """
+    Returns the cache file used for a 3MF file's BOM.
+    """
+    digest = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()
+    return os.path.join(BOM_CACHE_DIR, f"{digest}.json")
 
+def load_cached_bom(filepath, key):
+    """
+    Returns the cached BOM Counter for a 3MF file, or None if missing or stale.
+    """
+    try:
+        with open(bom_cache_path(filepath), 'r') as f:
+            cached = json.load(f)
+        if cached.get('key') != key:
+            return None
+        return Counter(dict(cached['bom']))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_cached_bom(filepath, key, bom):
+    """
+    Stores a BOM Counter in the cache. Failures are ignored, the cache is only an optimization.
+    """
     try:
-        with zipfile.ZipFile(filepath, 'r') as zf:
-            model_xml_content = None
+        os.makedirs(BOM_CACHE_DIR, exist_ok=True)
+        with open(bom_cache_path(filepath), 'w') as f:
+            json.dump({'key': key, 'bom': list(bom.items())}, f)
+    except OSError:
+        pass
 
+def read_bom(filepath):
+    """
+    Reads a 3MF file and parses the internal 3D model XML into a BOM Counter of part name -> quantity.
+    Returns None (after printing the error) if the file cannot be read.
+    """
+    try:
+        # Open the archive ourselves with a large buffer, so reading compressed
+        # member data takes far fewer read() syscalls than the default 8 KiB buffer
+        with open(filepath, 'rb', buffering=ARCHIVE_READ_BUFFER_SIZE) as fh, \
+             zipfile.ZipFile(fh, 'r') as zf:
             # Check for the two common paths as 3MF is case-sensitive
-            try:
-                model_xml_content = zf.read('3D/3dmodel.model')
-            except KeyError:
+            model_info = find_member(zf, ('3D/3dmodel.model', '3d/3dmodel.model'))
+            if model_info is None:
+                raise KeyError("The 3MF archive is missing the required '3D/3dmodel.model' or '3d/3dmodel.model' file.")
+
+            # Stream-parse the main model XML
+            # resource_names_fallback holds generic names from <resources> (usually single strings)
+            with open_member(zf, model_info, MODEL_READ_BUFFER_SIZE) as model_file:
                 try:
-                    model_xml_content = zf.read('3d/3dmodel.model')
-                except KeyError:
-                    raise KeyError("The 3MF archive is missing the required '3D/3dmodel.model' or '3d/3dmodel.model' file.")
+                    resource_names_fallback, build_object_ids = scan_model_xml(model_file)
+                except ET.ParseError as e:
+                    print(f"Error: Failed to parse XML in 3dmodel.model: {e}")
+                    return None
 
             # Pre-load metadata names. Returns Dict[ID -> List[Names]]
             metadata_names_map = extract_names_from_config(zf)
 
     except Exception as e:
         print(f"Error accessing 3MF file: {e}")
-        return
+        return None
 
-    # Parse the main model XML
-    try:
-        root = ET.fromstring(model_xml_content)
-    except ET.ParseError as e:
-        print(f"Error: Failed to parse XML in 3dmodel.model: {e}")
-        return
+    if build_object_ids is None:
+        if resource_names_fallback is not None:
+             print("Warning: Found resources but could not find '<build>' section.")
+        return Counter()
 
-    # Extract generic names from <resources> as fallback
-    # These are usually single strings
-    resource_names_fallback = {}
-    resources = find_child_by_name(root, 'resources')
+    # Merge both name sources into one map so each build item needs a single lookup.
+    # Metadata Config names (specific slicer settings, possibly several per object)
+    # override the standard 3MF resource names.
+    names_by_id = {object_id: [name] for object_id, name in (resource_names_fallback or {}).items() if name}
+    names_by_id.update(metadata_names_map)
 
-    if resources is not None:
-        for obj in find_all_children_by_name(resources, 'object'):
-            object_id = obj.get('id')
-            object_name = obj.get('name')
-            if object_id:
-                resource_names_fallback[object_id] = clean_part_name(object_name)
+    get_names = names_by_id.get
+    final_bom_list = []
+    append = final_bom_list.append
+    extend = final_bom_list.extend
 
-    # Extract build items
-    build = find_child_by_name(root, 'build')
+    for object_id in build_object_ids:
+        names = get_names(object_id)
+        if names:
+            extend(names)
+        else:
+            append(f"Unnamed Object (ID: {object_id})")
 
-    final_bom_list = []
+    # Compile BOM
+    return Counter(final_bom_list)
 
-    if build is not None:
-        for item in find_all_children_by_name(build, 'item'):
-            object_id = item.get('objectid')
-            if object_id:
-                # 1. Try Metadata Config (Specific Slicer Settings)
-                # This might return a LIST of names if the object has multiple parts
-                if object_id in metadata_names_map:
-                    final_bom_list.extend(metadata_names_map[object_id])
+def parse_3mf_for_bom(filepath: str, show_urls: bool = False, use_cache: bool = True):
+    """
+    Reads a 3MF file, parses the internal 3D model XML, and prints a Bill of Materials (BOM).
+    Unless use_cache is False, a BOM cached from an earlier run on the unchanged file is reused.
+    """
+    if not os.path.exists(filepath):
+        print(f"Error: File not found at '{filepath}'")
+        return
 
-                # 2. Try Standard 3MF Resources
-                elif object_id in resource_names_fallback and resource_names_fallback[object_id]:
-                    final_bom_list.append(resource_names_fallback[object_id])
+    print(f"--- Analyzing 3MF File: {os.path.basename(filepath)} ---")
 
-                # 3. Fallback
-                else:
-                    final_bom_list.append(f"Unnamed Object (ID: {object_id})")
-    else:
-        if resources is not None:
-             print("Warning: Found resources but could not find '<build>' section.")
+    cache_key = bom_cache_key(filepath)
+    bom = load_cached_bom(filepath, cache_key) if use_cache else None
 
-    # Compile BOM
-    bom = Counter(final_bom_list)
+    if bom is None:
+        bom = read_bom(filepath)
+        if bom is None:
+            return
+        if use_cache:
+            save_cached_bom(filepath, cache_key, bom)
 
     print("\nBill of Materials (BOM):")
 
@@ -233,37 +355,43 @@ def parse_3mf_for_bom(filepath: str, show_urls: bool = False):
         print("No parts were found in the model's build section.")
         return
 
+    # Build the whole table and write it in one call instead of one print() per part
+    separator = "-" * (100 if show_urls else 55)
+    format_row = "{:<10} | {:<40}".format
+    lines = [separator]
+    append = lines.append
+
     # Adjust table header based on URL visibility
-    print("-" * (100 if show_urls else 55))
     if show_urls:
-        print(f"{'Quantity':<10} | {'Part Name':<40} | {'Thangs URL'}")
+        append(f"{'Quantity':<10} | {'Part Name':<40} | {'Thangs URL'}")
     else:
-        print(f"{'Quantity':<10} | {'Part Name':<40}")
-    print("-" * (100 if show_urls else 55))
+        append(format_row('Quantity', 'Part Name'))
+    append(separator)
 
     # Sort by Name (Case-insensitive)
     sorted_bom_items = sorted(bom.items(), key=lambda x: x[0].lower())
 
     for name, count in sorted_bom_items:
-        output_line = f"{count:<10} | {name:<40}"
+        output_line = format_row(count, name)
 
         if show_urls:
             # Generate Thangs search URL only if flag is enabled
             thangs_urls = search_thangs(name)
             if thangs_urls:
-                urls_str = ", ".join(thangs_urls)
-                output_line += f" | {urls_str}"
+                output_line += " | " + ", ".join(thangs_urls)
 
-        print(output_line)
+        append(output_line)
 
-    print("-" * (100 if show_urls else 55))
+    append(separator)
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parse a 3MF file to generate a Bill of Materials.")
     parser.add_argument("filepath", help="Path to the .3mf file")
     parser.add_argument("--multiboard", action="store_true", help="Include Thangs.com search URLs in the output")
+    parser.add_argument("--no-cache", action="store_true", help="Always re-parse the file instead of using a cached BOM")
 
     args = parser.parse_args()
 
-    parse_3mf_for_bom(args.filepath, show_urls=args.multiboard)
+    parse_3mf_for_bom(args.filepath, show_urls=args.multiboard, use_cache=not args.no_cache)
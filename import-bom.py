@@ -1,17 +1,29 @@
 import argparse
 import os
 import sys
+import re
 import tempfile
 import subprocess
-import requests
-from typing import List, Optional, Dict
-
-# Attempt to import BeautifulSoup, needed for web parsing/scraping
+import shutil
+import threading
+import urllib.parse
+import email.message
+import contextlib
+import hashlib
+import json
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Dict
+
+# requests downloads the files and lxml parses the Thangs pages. Both are needed
+# before any of the code below can run, so a missing one is reported here.
 try:
-    from bs4 import BeautifulSoup
-except ImportError:
-    # This error will be raised clearly in the __main__ block if not found
-    BeautifulSoup = None
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    from lxml import etree as lxml_etree
+except ImportError as e:
+    raise ImportError(f"The '{e.name}' library is required. Install it using: pip install {e.name}") from e
 
 # --- Configuration ---
 # NOTE: Replace 'prusa-slicer' with the full path to the executable if it is not
@@ -19,6 +31,204 @@ except ImportError:
 # on Windows or '/Applications/PrusaSlicer.app/Contents/MacOS/prusa-slicer' on macOS).
 PRUSA_SLICER_COMMAND = 'prusa-slicer'
 
+# File extensions PrusaSlicer can load, also used to spot direct download links
+MODEL_FILE_EXTENSIONS = ('.stl', '.amf', '.obj', '.3mf')
+
+# Quantity column of a BOM line, e.g. "4" or "4x"
+QUANTITY_RE = re.compile(r'\d+')
+
+# Column 3 of a BOM line must start with one of these to be accepted as a URL
+BOM_URL_PREFIXES = ('http', 'ftp')
+
+# Sources starting with one of these are downloaded, anything else is a local path
+REMOTE_URL_PREFIXES = ('http://', 'https://')
+
+# Runs of characters that are replaced in downloaded file names
+UNSAFE_FILENAME_RE = re.compile(r'[^\w.\- ]+')
+
+# Downloaded file names longer than this are shortened, keeping the extension
+MAX_FILENAME_LENGTH = 50
+
+# Downloaded files are kept here between runs, along with the ETag/Last-Modified
+# headers needed to ask the server whether they have changed (disable with --no-cache)
+DOWNLOAD_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), '3mf-tools', 'downloads')
+
+# Once the cache grows past this size, the least recently used downloads are removed
+DOWNLOAD_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Block size used when copying downloaded files to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of files resolved/downloaded concurrently. The threads spend nearly all
+# their time waiting on sockets, so this is bounded by politeness, not CPU.
+# Can be changed with --max-concurrent.
+MAX_DOWNLOAD_WORKERS = 16
+
+# Number of requests, page fetches and file downloads alike, allowed in flight to
+# any one host, so thangs.com (which serves both) is not hammered. Each host has
+# its own allowance, so downloads from a CDN host do not wait on thangs.com.
+# Can be changed with --max-per-host.
+MAX_REQUESTS_PER_HOST = 6
+
+# Longest PrusaSlicer command line we will build. Windows allows 32767 characters;
+# longer file lists are split into batches that are sliced separately and merged.
+MAX_COMMAND_LENGTH = 32000
+
+# Shared HTTP session for all scraping and downloads. Reusing it keeps connections
+# alive between requests, and transient server errors are retried with backoff.
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'})
+
+def mount_session_adapter(pool_size: int):
+    """
+    Mounts a retrying HTTPAdapter on SESSION that keeps up to pool_size connections
+    per host. Keep at least one pooled connection per download thread, or urllib3
+    discards the extras and has to reconnect.
+    """
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size,
+                          max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]))
+    SESSION.mount('https://', adapter)
+    SESSION.mount('http://', adapter)
+
+mount_session_adapter(MAX_DOWNLOAD_WORKERS)
+
+class HostLimiter:
+    """
+    Hands out a fixed number of request slots per host, shared by all threads.
+    Used for every page fetch and download, since hammering one site gets us throttled.
+    The limit is read when a host is first seen, so set it before any requests.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, url: str):
+        """Blocks until a request to the URL's host may be made, for the duration of the with block."""
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+        with semaphore:
+            yield
+
+HOST_LIMITER = HostLimiter(MAX_REQUESTS_PER_HOST)
+
+# Held while writing a line to the console, so output from concurrent threads stays on separate lines
+OUTPUT_LOCK = threading.Lock()
+
+def log(message: str, file=None):
+    """
+    Prints a message from code that runs on worker threads. print() writes the text
+    and the line ending separately, so concurrent calls could run together on one line.
+    """
+    out = file or sys.stdout
+    with OUTPUT_LOCK:
+        out.write(message + '\n')
+        out.flush()
+
+def declared_encoding(response: requests.Response) -> Optional[str]:
+    """
+    Returns the charset named in the response's Content-Type header, or None.
+    """
+    header = email.message.Message()
+    header['Content-Type'] = response.headers.get('Content-Type', '')
+    return header.get_content_charset()
+
+def response_filename(response: requests.Response) -> Optional[str]:
+    """
+    Returns the file name given in the response's Content-Disposition header or,
+    failing that, the last part of the final (post-redirect) URL's path. The name
+    is reduced to safe characters with no directory part. Returns None if neither
+    gives a name.
+    """
+    header = email.message.Message()
+    header['Content-Disposition'] = response.headers.get('Content-Disposition', '')
+    filename = header.get_filename()
+    if not filename:
+        filename = urllib.parse.unquote(urllib.parse.urlsplit(response.url).path.rsplit('/', 1)[-1])
+    filename = UNSAFE_FILENAME_RE.sub('_', os.path.basename(filename.replace('\\', '/'))).strip(' .')
+    return filename or None
+
+def iter_page_links(response: requests.Response):
+    """
+    Yields the <a> elements of a streamed HTML response.
+
+    The page is parsed as it arrives, so a caller that stops iterating early never
+    downloads the rest of the page. A charset declared by the server is passed to
+    the parser; without one UTF-8 is assumed, as libxml2 would read the page as Latin-1.
+    """
+    encoding = declared_encoding(response) or 'utf-8'
+
+    response.raw.decode_content = True
+    try:
+        links = lxml_etree.iterparse(response.raw, events=('end',), tag='a', html=True, encoding=encoding)
+    except LookupError:
+        # A charset libxml2 does not know, assume UTF-8 as for an undeclared one
+        links = lxml_etree.iterparse(response.raw, events=('end',), tag='a', html=True, encoding='utf-8')
+
+    try:
+        for _, link in links:
+            yield link
+            link.clear()
+    except lxml_etree.XMLSyntaxError:
+        # Raised for an empty document, treat it as a page without links
+        return
+
+def find_page_link(url: str, preferred, fallback=None) -> Optional[str]:
+    """
+    Fetches an HTML page and returns the href of the first <a> element for which
+    preferred(element) is true, stopping as soon as one is found. If there is none,
+    returns the href of the first element for which fallback(element) is true, or None.
+    """
+    fallback_href = None
+    with HOST_LIMITER.slot(url), SESSION.get(url, stream=True, timeout=15) as response:
+        response.raise_for_status()
+        for link in iter_page_links(response):
+            href = link.get('href')
+            if not href:
+                continue
+            if preferred(link):
+                return href
+            if fallback_href is None and fallback is not None and fallback(link):
+                fallback_href = href
+    return fallback_href
+
+# These checks find the Thangs links we need.
+# They are highly prone to breaking if Thangs updates their site.
+def is_model_link(link) -> bool:
+    """The link to a model page from the search results."""
+    return '/3d-model/' in link.get('href', '')
+
+def is_model_file_url(url: str) -> bool:
+    """True if the URL path (ignoring any query string) names a model file."""
+    return urllib.parse.urlsplit(url).path.rstrip('/').lower().endswith(MODEL_FILE_EXTENSIONS)
+
+def is_model_file_link(link) -> bool:
+    """A direct link to a model file."""
+    return is_model_file_url(link.get('href', ''))
+
+def is_download_button(link) -> bool:
+    """The download button on a model page."""
+    return link.get('data-testid') == 'download-file-button'
+
+def is_download_link(link) -> bool:
+    """A more generic link that often leads to the download process."""
+    return '/download/' in link.get('href', '')
+
+def normalize_url(url: str) -> str:
+    """
+    Returns a canonical spelling of a URL, so near-duplicates in the input compare
+    equal: the scheme and host are lowercased, a leading "www." and trailing slash
+    are dropped, query parameters are sorted and any fragment is removed.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix('www.')
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((parts.scheme.lower(), host, parts.path.rstrip('/') or '/', query, ''))
+
 def get_thangs_download_url(search_url: str) -> Optional[str]:
     """
     Fetches a Thangs search URL, navigates to the first model page, and attempts
@@ -33,194 +243,494 @@ def get_thangs_download_url(search_url: str) -> Optional[str]:
     Returns:
         The direct link to the downloadable file (STL/3MF/etc.) or None on failure.
     """
-    if BeautifulSoup is None:
-        print("    [Thangs Scraper] BeautifulSoup library not found. Cannot process Thangs URLs.", file=sys.stderr)
-        return None
-
     base_url = "https://thangs.com"
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+    # URLs are resolved side by side, so say which one each line is about
+    prefix = f"    [Thangs Scraper] {search_url}: "
+
+    # Already a direct link to a model file, nothing to scrape
+    if is_model_file_url(search_url):
+        return search_url
 
     model_url = search_url
 
     # --- 1. Resolve Search URL to Model Page URL (If necessary) ---
     if "/search/" in search_url:
         try:
-            print(f"    [Thangs Scraper] Fetching search page to find model link...")
-            response = requests.get(search_url, headers=headers, timeout=15)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # This selector attempts to find the link to the first model result.
-            # This is highly prone to breaking if Thangs updates their site.
-            first_model_link = soup.select_one('a[href*="/3d-model/"]')
-
-            if first_model_link and first_model_link.get('href'):
-                model_path = first_model_link['href']
+            log(f"{prefix}Fetching search page to find model link...")
+            # Find the link to the first model result, or a direct model file link
+            # which saves fetching the model page
+            model_path = find_page_link(search_url, lambda link: is_model_file_link(link) or is_model_link(link))
+
+            if model_path and is_model_file_url(model_path):
+                final_download_url = base_url + model_path if model_path.startswith('/') else model_path
+                log(f"{prefix}Found download URL on search page: {final_download_url}")
+                return final_download_url
+            elif model_path:
                 model_url = base_url + model_path
-                print(f"    [Thangs Scraper] Found model page link: {model_url}")
+                log(f"{prefix}Found model page link: {model_url}")
             else:
-                print("    [Thangs Scraper] Could not find a model link on the search results page. Trying search URL as model URL.")
+                log(f"{prefix}Could not find a model link on the search results page. Trying search URL as model URL.")
                 # Fallback: assume the search page might redirect or contain the download element itself (unlikely)
 
         except Exception as e:
-            print(f"    [Thangs Scraper] ERROR: Failed to parse search URL or find model link: {e}", file=sys.stderr)
+            log(f"{prefix}ERROR: Failed to parse search URL or find model link: {e}", file=sys.stderr)
             return None
 
     # --- 2. Fetch Model Page and Extract Download Link ---
     try:
-        print(f"    [Thangs Scraper] Fetching model page to find download URL...")
-        response = requests.get(model_url, headers=headers, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # This selector attempts to find the download button/link element.
+        log(f"{prefix}Fetching model page to find download URL...")
+        # Find the download button, or failing that a generic download link.
         # This is the most brittle part of the scraping process.
-        download_button = soup.select_one('a[data-testid="download-file-button"]')
-
-        if not download_button:
-             # Try a more generic link that often leads to the download process
-            download_button = soup.select_one('a[href*="/download/"]')
+        download_path = find_page_link(model_url, is_download_button, is_download_link)
 
-
-        if download_button and download_button.get('href'):
+        if download_path:
             # Thangs download links can be relative, so we ensure they are absolute
-            download_path = download_button['href']
             if download_path.startswith('/'):
                  final_download_url = base_url + download_path
             else:
                  final_download_url = download_path # Already absolute
 
-            print(f"    [Thangs Scraper] Found final download URL: {final_download_url}")
+            log(f"{prefix}Found final download URL: {final_download_url}")
             return final_download_url
 
-        print("    [Thangs Scraper] ERROR: Could not find the direct download link on the model page.")
+        log(f"{prefix}ERROR: Could not find the direct download link on the model page.")
         return None
 
     except Exception as e:
-        print(f"    [Thangs Scraper] ERROR: Failed to fetch model page or extract download link: {e}", file=sys.stderr)
+        log(f"{prefix}ERROR: Failed to fetch model page or extract download link: {e}", file=sys.stderr)
         return None
 
-def download_files(urls: List[str], target_dir: str) -> Dict[str, str]:
+def resolve_thangs_urls(urls: List[str], executor: ThreadPoolExecutor) -> Dict[str, str]:
+    """
+    Resolves all the Thangs URLs in the list to direct download links concurrently.
+    URLs that differ only in spelling (see normalize_url) are resolved once.
+
+    Returns:
+        A dictionary mapping each URL to the URL to download. Other URLs map to
+        themselves; Thangs URLs that could not be resolved are left out.
+    """
+    thangs_urls = [url for url in urls if 'thangs.com' in url.lower()]
+    # The first spelling of each normalized URL is the one fetched
+    urls_to_resolve = {}
+    for url in thangs_urls:
+        urls_to_resolve.setdefault(normalize_url(url), url)
+    for url in urls_to_resolve.values():
+        print(f"  Attempting to resolve Thangs URL: {url}")
+
+    resolved_by_key = dict(zip(urls_to_resolve, executor.map(get_thangs_download_url, urls_to_resolve.values())))
+    resolved = {url: resolved_by_key[normalize_url(url)] for url in thangs_urls}
+
+    download_urls = {}
+    for url in urls:
+        if url not in resolved:
+            download_urls[url] = url
+        elif resolved[url]:
+            download_urls[url] = resolved[url]
+        else:
+            print(f"  WARNING: Could not resolve Thangs URL {url}. Skipping.", file=sys.stderr)
+    return download_urls
+
+def download_cache_path(url: str) -> str:
+    """
+    Returns the cache directory used for a URL from the input file. The cache is
+    keyed on that URL rather than the one finally downloaded, as Thangs download
+    links are signed and change from run to run.
+    """
+    digest = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return os.path.join(DOWNLOAD_CACHE_DIR, digest)
+
+def load_download_meta(cache_dir: str) -> Optional[dict]:
+    """
+    Returns the metadata of a cached download, or None if there is no usable cached file.
+    """
+    try:
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if not os.path.isfile(os.path.join(cache_dir, meta['filename'])):
+            return None
+        if not (meta.get('etag') or meta.get('last_modified')):
+            return None
+        return meta
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def touch_download_meta(cache_dir: str):
+    """
+    Marks a cached download as just used, so it is the last to be pruned.
+    """
+    try:
+        os.utime(os.path.join(cache_dir, 'meta.json'))
+    except OSError:
+        pass
+
+def save_download_meta(cache_dir: str, meta: dict):
+    """
+    Stores the metadata of a cached download. Failures are ignored, the cache is only an optimization.
+    """
+    try:
+        with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    except OSError:
+        pass
+
+def prune_download_cache(keep: set, max_bytes: int = DOWNLOAD_CACHE_MAX_BYTES):
+    """
+    Removes the least recently used downloads until the cache is no larger than
+    max_bytes. The cache directories in keep, used by this run, are never removed.
+    Failures are ignored, the cache is only an optimization.
+    """
+    try:
+        names = os.listdir(DOWNLOAD_CACHE_DIR)
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        cache_dir = os.path.join(DOWNLOAD_CACHE_DIR, name)
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+        except OSError:
+            continue
+        try:
+            last_used = os.path.getmtime(os.path.join(cache_dir, 'meta.json'))
+        except OSError:
+            # No metadata, left by an interrupted download, so it goes first
+            last_used = 0
+        entries.append((last_used, size, cache_dir))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, cache_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        if cache_dir not in keep:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            total -= size
+
+def download_files(urls: List[str], target_dir: str, max_workers: int = MAX_DOWNLOAD_WORKERS,
+                   use_cache: bool = True,
+                   on_download: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
     """
     Downloads 3D files from a list of unique URLs into the specified temporary directory.
+    All Thangs URLs are resolved first, then each distinct file is downloaded once,
+    with up to max_workers requests in flight during each phase, and no more to any
+    one host than HOST_LIMITER allows.
+
+    With use_cache, files are saved in DOWNLOAD_CACHE_DIR instead and kept between
+    runs. A cached file is only fetched again if the server says it has changed,
+    and the cache is then pruned to DOWNLOAD_CACHE_MAX_BYTES.
 
     Args:
         urls: A list of unique strings, each being a URL to an STL file or a Thangs page.
         target_dir: The path to the directory where files will be saved.
+        max_workers: The maximum number of requests in flight at once.
+        use_cache: Whether to reuse and update the download cache.
+        on_download: If given, called from a download thread with each URL and its
+            local path as soon as that file is ready.
 
     Returns:
         A dictionary mapping the original URL to the local file path of the downloaded file.
     """
-    url_map = {}
-    print(f"Starting downloads to temporary directory: {target_dir}")
+    if use_cache:
+        print(f"Starting downloads to cache directory: {DOWNLOAD_CACHE_DIR}")
+    else:
+        print(f"Starting downloads to temporary directory: {target_dir}")
 
-    for i, url in enumerate(urls):
-        original_url = url # Keep the original for the map key
-        download_url = url
+    used_filenames = set()
+    filenames_lock = threading.Lock()
 
-        # --- Thangs URL Handling ---
-        if 'thangs.com' in url.lower():
-            print(f"  Attempting to resolve Thangs URL: {original_url}")
-            resolved_url = get_thangs_download_url(url)
-            if resolved_url:
-                download_url = resolved_url
-            else:
-                print(f"  WARNING: Could not resolve Thangs URL {original_url}. Skipping.", file=sys.stderr)
-                continue
-        # --- END Thangs Handling ---
+    used_cache_dirs = set()
 
+    def fetch(i: int, download_url: str, total: int, url: str) -> Optional[str]:
+        """Downloads a single file for the input URL url, returning the local path or None."""
         try:
-            print(f"  Downloading file {i+1}/{len(urls)}: {download_url}...")
+            log(f"  Downloading file {i+1}/{total}: {download_url}...")
+
+            # Ask the server to skip the body if our cached copy is still current,
+            # wherever the input URL resolved to this time
+            cache_dir = download_cache_path(url) if use_cache else None
+            meta = load_download_meta(cache_dir) if cache_dir else None
+            headers = {}
+            if meta and meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta and meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
             # Use streaming to handle potentially large files
-            # Add headers to mimic a browser request, which helps prevent 403 errors
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            with requests.get(download_url, stream=True, allow_redirects=True, timeout=30, headers=headers) as r:
+            # SESSION sends a browser User-Agent, which helps prevent 403 errors
+            with HOST_LIMITER.slot(download_url), \
+                 SESSION.get(download_url, headers=headers, stream=True, allow_redirects=True, timeout=30) as r:
+                if r.status_code == 304 and meta:
+                    local_path = os.path.join(cache_dir, meta['filename'])
+                    touch_download_meta(cache_dir)
+                    used_cache_dirs.add(cache_dir)
+                    log(f"  Not modified, using cached copy: {local_path}")
+                    return local_path
+
                 r.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
 
-                # Try to determine the filename from headers or default to index
-                filename = download_url.split('/')[-1]
-                if not filename or '.' not in filename or len(filename) > 50:
-                    # Fallback filename if URL doesn't provide a clear name or is too long
+                # Take the filename from the headers or the final URL, or default to index
+                filename = response_filename(r)
+                if not filename or '.' not in filename:
+                    # Fallback filename if the server doesn't provide a clear name
                     filename = f"model_{i+1}.stl"
-
-                # Clean filename of query params if present
-                if '?' in filename:
-                    filename = filename.split('?')[0]
+                elif len(filename) > MAX_FILENAME_LENGTH:
+                    # Shorten long names but keep the real extension, so a .3mf stays a .3mf
+                    stem, ext = os.path.splitext(filename)
+                    filename = stem[:max(1, MAX_FILENAME_LENGTH - len(ext))] + ext
 
                 # Ensure the filename ends with a 3D model extension (PrusaSlicer requirement)
-                if not filename.lower().endswith(('.stl', '.amf', '.obj', '.3mf')):
+                if not filename.lower().endswith(MODEL_FILE_EXTENSIONS):
                      filename = os.path.splitext(filename)[0] + '.stl'
 
-                local_path = os.path.join(target_dir, filename)
-
-                # Write the file content in chunks
-                with open(local_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
+                if cache_dir:
+                    # Each input URL has a cache directory of its own, so names cannot clash
+                    os.makedirs(cache_dir, exist_ok=True)
+                    used_cache_dirs.add(cache_dir)
+                    local_path = os.path.join(cache_dir, filename)
+                else:
+                    # Downloads run concurrently, so two URLs must never write the same file
+                    with filenames_lock:
+                        if filename in used_filenames:
+                            filename = f"{i+1}_{filename}"
+                        used_filenames.add(filename)
+
+                    local_path = os.path.join(target_dir, filename)
+
+                # Write the file content in large blocks straight from the raw stream,
+                # letting urllib3 undo any gzip/deflate Content-Encoding. The file only
+                # gets its real name once complete, so an interrupted download is never
+                # mistaken for a cached copy.
+                r.raw.decode_content = True
+                partial_path = local_path + '.part'
+                with open(partial_path, 'wb') as f:
+                    shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                os.replace(partial_path, local_path)
+
+                if cache_dir:
+                    if meta and meta['filename'] != filename:
+                        # The server renamed the file, drop the stale copy
+                        try:
+                            os.remove(os.path.join(cache_dir, meta['filename']))
+                        except OSError:
+                            pass
+                    save_download_meta(cache_dir, {'url': url, 'filename': filename,
+                                                   'etag': r.headers.get('ETag'),
+                                                   'last_modified': r.headers.get('Last-Modified')})
 
-                url_map[original_url] = local_path
-                print(f"  Successfully saved to: {local_path}")
+                log(f"  Successfully saved to: {local_path}")
+                return local_path
 
         except requests.exceptions.RequestException as e:
-            print(f"  ERROR: Failed to download {url}. Reason: {e}", file=sys.stderr)
+            log(f"  ERROR: Failed to download {download_url}. Reason: {e}", file=sys.stderr)
         except Exception as e:
-            print(f"  An unexpected error occurred during download: {e}", file=sys.stderr)
-
-    return url_map
+            log(f"  An unexpected error occurred during download: {e}", file=sys.stderr)
+        return None
 
-def run_prusa_slicer(stl_files: List[str], output_path: str):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # --- 1. Resolve Thangs URLs (all at once, the scraping is network bound) ---
+        download_urls = resolve_thangs_urls(urls, executor)
+
+        # --- 2. Download each distinct file once, even if several URLs resolve to it ---
+        urls_by_download_url = {}
+        for url, download_url in download_urls.items():
+            urls_by_download_url.setdefault(download_url, []).append(url)
+
+        def fetch_and_report(i: int, download_url: str, total: int) -> Optional[str]:
+            # Cached under the first input URL that resolved to it
+            local_path = fetch(i, download_url, total, urls_by_download_url[download_url][0])
+            if local_path and on_download:
+                for url in urls_by_download_url[download_url]:
+                    on_download(url, local_path)
+            return local_path
+
+        unique_download_urls = list(urls_by_download_url)
+        total = len(unique_download_urls)
+        local_paths = executor.map(fetch_and_report, range(total), unique_download_urls, [total] * total)
+        path_by_download_url = dict(zip(unique_download_urls, local_paths))
+
+    if use_cache:
+        prune_download_cache(used_cache_dirs)
+
+    return {url: path_by_download_url[download_url]
+            for url, download_url in download_urls.items() if path_by_download_url[download_url]}
+
+def relay_output(pipe, out, prefix: str = ''):
+    """Copies lines from a child process pipe to one of our own streams until EOF."""
+    for line in pipe:
+        with OUTPUT_LOCK:
+            out.write(prefix + line)
+            out.flush()
+
+def prusa_slicer_command(model_files: List[str], output_path: str, copies: int = 1) -> List[str]:
     """
-    Executes the prusa-slicer command with the downloaded files and export flag.
+    Builds the PrusaSlicer command line that combines model_files into output_path,
+    with each model loaded once and placed copies times.
 
-    Args:
-        stl_files: A list of local paths to the 3D files.
-        output_path: The desired path for the final 3MF output file.
+    --export-3mf only selects the action; the file written is named by --output.
+    Without --merge PrusaSlicer exports every input as a project of its own, so
+    it is needed to get all the models into one 3MF.
     """
-    if not stl_files:
-        print("No files (local or remote) were found to process. Skipping PrusaSlicer execution.")
-        return
+    command = [PRUSA_SLICER_COMMAND, '--export-3mf', '--merge', '--output', output_path]
+    if copies > 1:
+        command += ['--duplicate', str(copies)]
+    return command + model_files
 
-    # Construct the command line argument list
-    command = [
-        PRUSA_SLICER_COMMAND,
-        '--export-3mf',
-        output_path
-    ]
+def command_length(model_files: List[str]) -> int:
+    """Estimated number of characters the files add to a command line, allowing for quoting."""
+    return sum(len(path) + 3 for path in model_files)
 
-    # Add all file paths (both downloaded and local)
-    command.extend(stl_files)
+class SlicerNotFoundError(Exception):
+    """Raised when the PrusaSlicer executable cannot be found."""
+
+def slice_batch(model_files: List[str], output_path: str, label: str = '', copies: int = 1):
+    """
+    Runs PrusaSlicer on one batch of files, relaying its output as it is produced.
+    Raises subprocess.CalledProcessError if PrusaSlicer fails, or SlicerNotFoundError
+    if it cannot be started.
+    """
+    command = prusa_slicer_command(model_files, output_path, copies)
 
-    print("\n--- Running PrusaSlicer Command ---")
+    log(f"\n--- Running PrusaSlicer Command{' ' + label if label else ''} ---")
     # Truncate output if it's extremely long due to many duplicated files
     cmd_str = " ".join(command)
     if len(cmd_str) > 1000:
-        print(cmd_str[:1000] + " ... [command truncated]")
+        log(cmd_str[:1000] + " ... [command truncated]")
     else:
-        print(cmd_str)
+        log(cmd_str)
 
+    # Execute the command, relaying its output line by line as it is produced
+    # rather than buffering it all until exit, so long slicing runs show progress.
+    # stderr is relayed on a second thread so neither pipe can fill up and stall
+    # PrusaSlicer while we wait on the other.
+    prefix = f"[{label}] " if label else ''
     try:
-        # Execute the command
-        # PrusaSlicer is often a GUI application, so capturing output might block.
-        # We rely on the return code for success/failure.
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, errors='replace', bufsize=1)
+    except FileNotFoundError as e:
+        raise SlicerNotFoundError(PRUSA_SLICER_COMMAND) from e
+    with proc:
+        stderr_relay = threading.Thread(target=relay_output, args=(proc.stderr, sys.stderr, prefix), daemon=True)
+        stderr_relay.start()
+        relay_output(proc.stdout, sys.stdout, prefix)
+        stderr_relay.join()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+class SlicePipeline:
+    """
+    Combines files into a 3MF with PrusaSlicer as they become available, so it can
+    start on the first files while later ones are still downloading.
+
+    Files are collected into batches of up to batch_size files, whatever number of
+    copies each needs, and each full batch is sliced into a partial 3MF by one of
+    up to parallel PrusaSlicer processes running side by side. A batch is also
+    started early if another file would not fit on its command line. With no
+    batch_size everything normally goes into one PrusaSlicer run that writes the
+    output directly.
+
+    PrusaSlicer's --duplicate option applies to every model on the command line, so
+    it is only used for a batch whose files all need the same number of copies;
+    otherwise each path is repeated once per copy.
+
+    add() may be called from any thread. finish() slices whatever is left and
+    merges the parts into the final output. Use it as a context manager so no
+    PrusaSlicer runs are left going if the with block fails.
+    """
+    def __init__(self, output_path: str, parts_dir: str, parallel: int = 1, batch_size: Optional[int] = None):
+        self.output_path = output_path
+        self.parts_dir = parts_dir
+        self.batch_size = batch_size
+        # PrusaSlicer has no response file option, so the paths must fit on the command line
+        longest_output = max(output_path, os.path.join(parts_dir, "part99999.3mf"), key=len)
+        self._max_length = MAX_COMMAND_LENGTH - command_length(prusa_slicer_command([], longest_output, 10**9))
+        # The work happens in the PrusaSlicer processes, so threads are enough to drive them
+        self._executor = ThreadPoolExecutor(max_workers=parallel)
+        self._pending: List[tuple] = []
+        self._part_paths: List[str] = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def _arguments(entries: List[tuple]):
+        """Returns the files and --duplicate count of the PrusaSlicer run for a batch."""
+        entries = sorted(entries)
+        copies = {copies for _, _, copies in entries}
+        if len(copies) == 1:
+            return [path for _, path, _ in entries], copies.pop()
+        return [path for _, path, copies in entries for _ in range(copies)], 1
+
+    def add(self, path: str, copies: int, order: int = 0):
+        """
+        Queues copies of a file, starting its batch once enough files have arrived.
+        order sets where the file goes among the others, whatever order they arrive in.
+        """
+        with self._lock:
+            entry = (order, path, copies)
+            if self._pending and command_length(self._arguments(self._pending + [entry])[0]) > self._max_length:
+                self._submit()
+            self._pending.append(entry)
+            if self.batch_size and len(self._pending) >= self.batch_size:
+                self._submit()
+
+    def _submit(self):
+        """Starts slicing the pending files into a new part. Must be called with the lock held."""
+        model_files, copies = self._arguments(self._pending)
+        self._pending = []
+        part_path = os.path.join(self.parts_dir, f"part{len(self._part_paths)+1}.3mf")
+        self._part_paths.append(part_path)
+        self._futures.append(self._executor.submit(
+            slice_batch, model_files, part_path, f"part {len(self._part_paths)}", copies))
+
+    def finish(self):
+        """
+        Slices the remaining files, waits for every batch and merges the parts into
+        the output. Raises subprocess.CalledProcessError if any PrusaSlicer run fails.
+        """
+        with self._lock:
+            if not self._part_paths:
+                if not self._pending:
+                    print("No files (local or remote) were found to process. Skipping PrusaSlicer execution.")
+                    return
+                # Everything fitted in one batch, so slice it straight into the output
+                model_files, copies = self._arguments(self._pending)
+                self._pending = []
+                slice_batch(model_files, self.output_path, copies=copies)
+                parts = []
+            else:
+                if self._pending:
+                    self._submit()
+                parts = self._part_paths
 
-        print("\nPrusaSlicer execution successful.")
-        print(f"3MF file created at: {os.path.abspath(output_path)}")
+        for future in self._futures:
+            future.result()
+
+        if len(parts) == 1:
+            # Nothing to merge, the only part is the finished file
+            shutil.move(parts[0], self.output_path)
+        elif parts:
+            slice_batch(parts, self.output_path, "merge")
 
-        # Optional: Print captured output if any (might be empty for GUI apps)
-        if result.stdout:
-            print("\nPrusaSlicer Output (stdout):")
-            print(result.stdout)
-        if result.stderr:
-            print("\nPrusaSlicer Output (stderr):")
-            print(result.stderr)
+        print("\nPrusaSlicer execution successful.")
+        print(f"3MF file created at: {os.path.abspath(self.output_path)}")
 
+@contextlib.contextmanager
+def slicer_errors():
+    """Reports a failed PrusaSlicer run raised in the with block and exits."""
+    try:
+        yield
     except subprocess.CalledProcessError as e:
         print(f"\nERROR: PrusaSlicer exited with a non-zero status code {e.returncode}.", file=sys.stderr)
-        print("PrusaSlicer Error Output (stderr):", file=sys.stderr)
-        print(e.stderr, file=sys.stderr)
+        print("See the PrusaSlicer error output above for details.", file=sys.stderr)
         sys.exit(1)
-    except FileNotFoundError:
+    except SlicerNotFoundError:
         print(f"\nERROR: PrusaSlicer executable '{PRUSA_SLICER_COMMAND}' not found.", file=sys.stderr)
         print("Please ensure PrusaSlicer is installed and accessible in your system's PATH, or update the PRUSA_SLICER_COMMAND variable in the script.", file=sys.stderr)
         sys.exit(1)
@@ -228,12 +738,19 @@ def run_prusa_slicer(stl_files: List[str], output_path: str):
         print(f"\nAn unexpected error occurred during PrusaSlicer execution: {e}", file=sys.stderr)
         sys.exit(1)
 
-def parse_input_file(filepath: str) -> List[dict]:
+@dataclass(slots=True)
+class BomItem:
+    """One part to import: where it comes from, how many are needed, and where it ended up locally."""
+    source: str
+    quantity: int = 1
+    is_remote: bool = False
+    local_path: Optional[str] = None
+
+def parse_input_file(filepath: str) -> Iterator[BomItem]:
     """
     Parses the input file. Supports simple URL lists and BOM (Bill of Materials) formats.
-    Returns a list of dicts: {'source': str, 'quantity': int}
+    Yields a BomItem per line as the file is read, already marked as remote or local.
     """
-    items = []
     try:
         with open(filepath, 'r') as f:
             for line in f:
@@ -251,12 +768,13 @@ def parse_input_file(filepath: str) -> List[dict]:
                             # Parse Quantity
                             qty_str = parts[0]
                             # Handle cases where quantity might be "1x" or similar, though "4" is standard
-                            qty = int(re.search(r'\d+', qty_str).group()) if re.search(r'\d+', qty_str) else 1
+                            qty_match = QUANTITY_RE.search(qty_str)
+                            qty = int(qty_match.group()) if qty_match else 1
 
                             # Column index 2 is usually the URL in the provided format
                             source = parts[2]
-                            if source.lower().startswith(('http', 'ftp')):
-                                items.append({'source': source, 'quantity': qty})
+                            if source.lower().startswith(BOM_URL_PREFIXES):
+                                yield BomItem(source, qty, source.lower().startswith(REMOTE_URL_PREFIXES))
                             else:
                                 print(f"  Skipping BOM line (invalid URL in col 3): {line}", file=sys.stderr)
                         except (ValueError, IndexError):
@@ -267,13 +785,11 @@ def parse_input_file(filepath: str) -> List[dict]:
                 else:
                     # Simple list format: "URL" or "path"
                     # Default quantity is 1
-                    items.append({'source': line, 'quantity': 1})
+                    yield BomItem(line, 1, line.lower().startswith(REMOTE_URL_PREFIXES))
     except Exception as e:
         print(f"Error reading input file: {e}", file=sys.stderr)
         sys.exit(1)
 
-    return items
-
 def main():
     """Main function to parse arguments and run the workflow."""
     parser = argparse.ArgumentParser(
@@ -306,84 +822,107 @@ python prusa_batch_processor.py input_urls.txt my_project.3mf
         type=str,
         help="The filename for the resulting 3MF project file (e.g., 'my_project.3mf')."
     )
+    parser.add_argument(
+        '--max-concurrent',
+        type=int,
+        default=MAX_DOWNLOAD_WORKERS,
+        help=f"Maximum number of downloads/page fetches in flight at once (default: {MAX_DOWNLOAD_WORKERS})."
+    )
+    parser.add_argument(
+        '--max-per-host',
+        type=int,
+        default=MAX_REQUESTS_PER_HOST,
+        help=f"Maximum number of page fetches/downloads in flight to any one host (default: {MAX_REQUESTS_PER_HOST})."
+    )
+    parser.add_argument(
+        '--parallel-slice',
+        type=int,
+        default=1,
+        metavar='N',
+        help="Split the files across N PrusaSlicer processes run side by side, starting each batch as soon as "
+             "its files are downloaded, then merge their output (default: 1)."
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Download every file again instead of reusing unchanged files from the download cache."
+    )
 
     args = parser.parse_args()
-
-    # Needs regex for parse_input_file
-    global re
-    import re
+    if args.max_concurrent < 1 or args.max_per_host < 1 or args.parallel_slice < 1:
+        parser.error("--max-concurrent, --max-per-host and --parallel-slice must be at least 1")
+    HOST_LIMITER.limit = args.max_per_host
+    mount_session_adapter(args.max_concurrent)
 
     # 1. Parse Input
     print(f"Parsing input file: {args.url_input_file}")
-    items = parse_input_file(args.url_input_file)
+    # Total the quantity of each distinct source as the file is read, so every
+    # source is checked and fetched exactly once however many BOM lines repeat it,
+    # and sort the distinct sources into remote URLs and local files as we go
+    items: Dict[str, BomItem] = {}
+    unique_remote_urls = []
+    local_items = []
+    item_count = 0
+    for item in parse_input_file(args.url_input_file):
+        existing = items.get(item.source)
+        if existing is not None:
+            existing.quantity += item.quantity
+        else:
+            items[item.source] = item
+            if item.is_remote:
+                unique_remote_urls.append(item.source)
+            else:
+                local_items.append(item)
+        item_count += 1
 
     if not items:
         print(f"Input file '{args.url_input_file}' contains no valid items to process.")
         return
 
-    # 2. Separate into unique remote URLs and local files
-    unique_remote_urls = set()
-
-    for item in items:
-        src = item['source']
-        if src.lower().startswith(('http://', 'https://')):
-            unique_remote_urls.add(src)
-            item['is_remote'] = True
-        else:
-            item['is_remote'] = False
-            # Check local existence immediately
-            if not os.path.exists(src):
-                 print(f"  WARNING: Local file not found: {src}", file=sys.stderr)
+    # 2. Check local existence immediately, once per distinct path. The checks are
+    # run side by side, which hides the latency of slow or network filesystems.
+    if local_items:
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            exists = list(executor.map(os.path.exists, [item.source for item in local_items]))
+        for item, found in zip(local_items, exists):
+            if found:
+                item.local_path = os.path.abspath(item.source)
+            else:
+                 print(f"  WARNING: Local file not found: {item.source}", file=sys.stderr)
 
-    print(f"Found {len(items)} total items ({len(unique_remote_urls)} unique remote URLs).")
+    print(f"Found {item_count} total items ({len(unique_remote_urls)} unique remote URLs).")
 
-    # 3. Use a temporary directory for downloads
+    # 3. Use a temporary directory for the partial 3MF files, and for the downloads with --no-cache
     with tempfile.TemporaryDirectory() as tmpdir:
-        # Download unique remote files
-        url_to_path_map = {}
-        if unique_remote_urls:
-            url_to_path_map = download_files(list(unique_remote_urls), tmpdir)
-
-        # 4. Construct Final File List (Expanding Quantities)
-        final_file_list_to_slice = []
-
-        for item in items:
-            path_to_add = None
-
-            if item['is_remote']:
-                if item['source'] in url_to_path_map:
-                    path_to_add = url_to_path_map[item['source']]
-            elif os.path.exists(item['source']):
-                path_to_add = os.path.abspath(item['source'])
-
-            # If we resolved a valid path, add it 'quantity' times
-            if path_to_add:
-                for _ in range(item['quantity']):
-                    final_file_list_to_slice.append(path_to_add)
-
-        # 5. Call PrusaSlicer
-        try:
-            run_prusa_slicer(final_file_list_to_slice, args.output_3mf_file)
-        except Exception as e:
-             print(f"A critical error occurred: {e}", file=sys.stderr)
-             sys.exit(1)
-
-    print("\nTemporary downloaded files have been cleaned up.")
+        # 4./5. Slice the local files and the downloads as they arrive. With --parallel-slice
+        # the files are shared out in batches, each started as soon as its files are in, so
+        # PrusaSlicer works on the early downloads while the rest are still fetched
+        batch_size = -(-len(items) // args.parallel_slice) if args.parallel_slice > 1 else None
+        order = {source: i for i, source in enumerate(items)}
+        with SlicePipeline(args.output_3mf_file, tempfile.mkdtemp(prefix='parts_', dir=tmpdir),
+                           args.parallel_slice, batch_size) as pipeline:
+            for item in local_items:
+                if item.local_path:
+                    pipeline.add(item.local_path, item.quantity, order[item.source])
+
+            def add_download(url: str, path: str):
+                items[url].local_path = path
+                pipeline.add(path, items[url].quantity, order[url])
+
+            if unique_remote_urls:
+                download_files(unique_remote_urls, tmpdir, args.max_concurrent, not args.no_cache,
+                               on_download=add_download)
+
+            # Failed slicing runs surface here, as the batches started during the
+            # downloads are only waited for once they are done
+            with slicer_errors():
+                pipeline.finish()
+
+    if args.no_cache:
+        print("\nTemporary downloaded files have been cleaned up.")
+    else:
+        print(f"\nTemporary files have been cleaned up. Downloads are kept in {DOWNLOAD_CACHE_DIR}.")
 
 
 if __name__ == '__main__':
-    # Ensure 'requests' library is installed for downloading
-    try:
-        import requests
-    except ImportError:
-        print("The 'requests' library is required. Install it using: pip install requests", file=sys.stderr)
-        sys.exit(1)
-
-    # Ensure 'BeautifulSoup4' library is installed for scraping Thangs URLs
-    try:
-        from bs4 import BeautifulSoup
-    except ImportError:
-        # Optional dependency, warned about in scraper function
-        pass
-
     main()